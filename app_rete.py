@@ -2,76 +2,39 @@
 # Requisitos: pip install streamlit requests
 # Ejecuta: streamlit run app.py
 
-import requests
 import streamlit as st
+from concurrent.futures import wait
 from datetime import datetime
-import time, hmac, hashlib, base64, json
+import time
 
-# Colocar SIEMPRE antes de cualquier componente de UI
+# Colocar SIEMPRE antes de cualquier componente de UI (y antes de importar utils,
+# que lee st.secrets y registra cachés al importarse)
 st.set_page_config(page_title="Calculadora UF→CLP", page_icon="💡", layout="centered")
 
-# ==============================
-# Utils
-# ==============================
-def formato_clp(valor: float) -> str:
-    """Formatea CLP con miles con punto y sin decimales."""
-    entero = int(round(valor or 0, 0))
-    s = f"{entero:,}".replace(",", ".")
-    return f"$ {s}"
-
-def parse_num(s, default=0.0) -> float:
-    """
-    Convierte strings con ',' o '.' a float.
-    Acepta miles con punto (p.ej. '1.234,56').
-    """
-    try:
-        if isinstance(s, (int, float)):
-            return float(s)
-        s = str(s).strip()
-        # elimina separador de miles '.' y usa '.' como decimal
-        s = s.replace(".", "").replace(",", ".")
-        return float(s)
-    except Exception:
-        return float(default)
-
-@st.cache_data(ttl=60 * 60)
-def obtener_uf_hoy() -> tuple[float, str]:
-    """
-    Intenta obtener la UF de hoy desde mindicador.cl.
-    Retorna (valor_uf_en_clp, fuente_texto) o lanza excepción si falla.
-    """
-    url = "https://mindicador.cl/api/uf"
-    r = requests.get(url, timeout=10)
-    r.raise_for_status()
-    data = r.json()
-    serie = data.get("serie", [])
-    if not serie:
-        raise RuntimeError("Respuesta sin datos de UF")
-    valor = float(serie[0]["valor"])  # CLP por 1 UF
-    fecha_iso = serie[0]["fecha"]
-    fecha = datetime.fromisoformat(fecha_iso.replace("Z", "+00:00")).date().strftime("%d-%m-%Y")
-    return valor, f"mindicador.cl (UF del {fecha})"
+from utils import (
+    IVA_RATE,
+    NIVELES,
+    NIVEL_IDX,
+    TOPES_BASE,
+    ADMIN_PASSCODE,
+    is_admin,
+    formato_clp,
+    parse_num,
+    uf_future,
+    uf_estado,
+    dia_uf,
+    get_user_email,
+    get_query_param,
+    make_flash_token,
+    verify_flash_token,
+)
 
 # ==============================
 # Roles / Autorización
 # ==============================
-ADMINS = set(st.secrets.get("auth", {}).get("admins", []))
-ADMIN_PASSCODE = st.secrets.get("auth", {}).get("admin_passcode", None)
-
-def get_user_email():
-    """Compatibilidad st.user (nuevo) y experimental_user (viejo)."""
-    try:
-        if getattr(st, "user", None) and getattr(st.user, "email", None):
-            return st.user.email
-        if hasattr(st, "experimental_user") and st.experimental_user is not None:
-            return getattr(st.experimental_user, "email", None)
-    except Exception:
-        pass
-    return None
-
 user_email = get_user_email()
 if "is_manager" not in st.session_state:
-    st.session_state.is_manager = (user_email in ADMINS) if user_email else False
+    st.session_state.is_manager = is_admin(user_email) if user_email else False
 
 # Desbloqueo por passcode en la barra lateral (opcional)
 if not st.session_state.is_manager and ADMIN_PASSCODE:
@@ -87,63 +50,25 @@ is_manager = st.session_state.is_manager
 # ==============================
 # Tokens temporales para agentes (?flash=TOKEN)
 # ==============================
-TOKEN_KEY = st.secrets.get("auth", {}).get("token_key", "dev-secret-change-me")
-
-def make_flash_token(hours: int, n1_pct: float, tel_pct: float) -> str:
-    """Crea un token firmado con expiración y topes flash."""
-    payload = {
-        "exp": int(time.time()) + hours * 3600,
-        "n1": float(n1_pct),   # % Nivel 1
-        "tel": float(tel_pct), # % Telecierre
-        "v": 1,
-    }
-    msg = json.dumps(payload, separators=(",", ":")).encode()
-    sig = hmac.new(TOKEN_KEY.encode(), msg, hashlib.sha256).digest()
-    return base64.urlsafe_b64encode(msg + b"." + sig).decode()
-
-def verify_flash_token(token: str):
-    try:
-        data = base64.urlsafe_b64decode(token.encode())
-        msg, sig = data.rsplit(b".", 1)
-        expected = hmac.new(TOKEN_KEY.encode(), msg, hashlib.sha256).digest()
-        if not hmac.compare_digest(sig, expected):
-            return False, "Firma inválida"
-        payload = json.loads(msg.decode())
-        if payload.get("exp", 0) < time.time():
-            return False, "Token vencido"
-        return True, payload
-    except Exception as e:
-        return False, str(e)
-
-def get_query_param(name: str):
-    try:
-        return st.query_params.get(name, None)
-    except Exception:
-        q = st.experimental_get_query_params()
-        if name in q:
-            v = q[name]
-            return v[0] if isinstance(v, list) else v
-        return None
-
-# Lee ?flash=TOKEN y guarda en sesión
+def flash_active() -> bool:
+    return st.session_state.get("flash_until", 0) > time.time()
+
+# Lee ?flash=TOKEN y guarda en sesión; cada token (válido o no) se verifica una sola vez
 token_param = get_query_param("flash")
-if token_param:
+if token_param and st.session_state.get("flash_token_seen") != token_param:
     ok, payload = verify_flash_token(token_param)
+    st.session_state.flash_token_seen = token_param
+    st.session_state.flash_token_error = None if ok else payload
     if ok:
         st.session_state.flash_until = payload["exp"]
-        st.session_state.flash_topes = {
-            "Nivel 1": payload["n1"] / 100.0,
-            "Telecierre": payload["tel"] / 100.0,
-        }
-        st.success(
-            f"✅ Ofertas Flash habilitadas hasta "
-            f"{datetime.fromtimestamp(payload['exp']).strftime('%d-%m-%Y %H:%M')}"
-        )
-    else:
-        st.warning(f"Token Flash inválido: {payload}")
-
-def flash_active() -> bool:
-    return st.session_state.get("flash_until", 0) > time.time()
+        st.session_state.flash_topes = (payload["n1"] / 100.0, payload["tel"] / 100.0)
+if token_param and st.session_state.flash_token_error:
+    st.warning(f"Token Flash inválido: {st.session_state.flash_token_error}")
+elif token_param and flash_active():
+    st.success(
+        f"✅ Ofertas Flash habilitadas hasta "
+        f"{datetime.fromtimestamp(st.session_state.flash_until).strftime('%d-%m-%Y %H:%M')}"
+    )
 
 # ==============================
 # UI principal
@@ -155,16 +80,14 @@ st.caption(
 )
 st.caption(f"👤 Sesión: {user_email or 'Usuario público'} · Rol: {'Jefe' if is_manager else 'Agente'}")
 
-# --- Config de niveles y topes ---
-IVA_RATE = 0.19  # 19% Chile
-TOPES_BASE = {"Nivel 1": 0.25, "Telecierre": 0.40}
-TOPES_ACTIVOS = TOPES_BASE.copy()
+# --- Topes por nivel (constantes en utils) ---
+topes = TOPES_BASE
 
 col_nivel, col_flash = st.columns([2, 1])
 with col_nivel:
     nivel = st.radio(
         "Nivel de retención",
-        options=["Nivel 1", "Telecierre"],
+        options=NIVELES,
         index=0,
         horizontal=True,
     )
@@ -184,18 +107,18 @@ if activar_flash and is_manager:
         top_n1 = st.number_input("Tope Nivel 1 (%)", min_value=0.0, max_value=80.0, value=30.0, step=1.0)
     with c2:
         top_tel = st.number_input("Tope Telecierre (%)", min_value=0.0, max_value=80.0, value=50.0, step=1.0)
-    TOPES_ACTIVOS["Nivel 1"] = top_n1 / 100.0
-    TOPES_ACTIVOS["Telecierre"] = top_tel / 100.0
+    topes = (top_n1 / 100.0, top_tel / 100.0)
 
 # 2) Si AGENTE tiene enlace temporal válido:
 elif flash_active():
-    TOPES_ACTIVOS.update(st.session_state.get("flash_topes", {}))
+    topes = st.session_state.get("flash_topes", TOPES_BASE)
     mins = int((st.session_state.flash_until - time.time()) // 60)
     st.caption(f"⏳ Ofertas Flash activas por ~{mins} min.")
 
-# Panel para generar enlace temporal (solo jefes)
-if is_manager:
-    with st.expander("🔑 Enlace temporal de Ofertas Flash para agentes"):
+# Panel para generar enlace temporal (solo jefes). Un expander ejecuta su contenido
+# aunque esté cerrado; con el toggle los widgets solo existen cuando se abre el panel.
+if is_manager and st.toggle("🔑 Enlace temporal de Ofertas Flash para agentes", key="show_flash_panel"):
+    with st.container(border=True):
         horas = st.number_input("Duración (horas)", 1, 24, 4)
         n1 = st.number_input("Tope Nivel 1 (Flash %)", 0.0, 80.0, 30.0, 1.0)
         tel = st.number_input("Tope Telecierre (Flash %)", 0.0, 80.0, 50.0, 1.0)
@@ -208,23 +131,42 @@ if is_manager:
                 "Si ya tienes parámetros, añade &flash=..."
             )
 
-max_desc = TOPES_ACTIVOS[nivel]
+max_desc = topes[NIVEL_IDX[nivel]]
+max_desc_pct = int(max_desc * 100)
 
 # ------------------------------
 # UF SIEMPRE editable (se precarga desde API)
 # ------------------------------
-try:
-    uf_api, fuente = obtener_uf_hoy()
-except Exception:
-    uf_api, fuente = 39315.0, "UF manual (API no disponible)"
-
-col_api, _ = st.columns([2, 1])
-with col_api:
-    uf_valor_txt = st.text_input(
-        "Valor de 1 UF en CLP (editable)",
-        value=f"{int(round(uf_api)):n}".replace(",", "."),
-        help=f"Fuente sugerida: {fuente}. Puedes modificarla libremente."
-    )
+# Una vez obtenida, la UF del día queda en la sesión y los reruns no la vuelven a pedir.
+# La consulta corre en segundo plano; mientras tanto se usa el último valor conocido.
+UF_RESPALDO = 39315.0
+hoy = dia_uf()  # fecha de Chile, no la del servidor
+uf_cached = st.session_state.get("uf_cached")  # (día, valor, fuente)
+uf_pendiente = False
+if uf_cached and uf_cached[0] == hoy:
+    _, uf_api, fuente = uf_cached
+else:
+    uf_res = uf_estado(hoy)
+    uf_pendiente = uf_res is None
+    if uf_pendiente:
+        uf_api, fuente = uf_cached[1:] if uf_cached else (UF_RESPALDO, "UF manual (actualizando…)")
+        st.caption("⏳ Actualizando UF…")
+    elif uf_res[0] == "ok":
+        _, uf_api, fuente = uf_res
+        st.session_state.uf_cached = (hoy, uf_api, fuente)
+    else:
+        # Caída reciente de la API: no se espera la red, se reintenta en segundo plano.
+        # Se mantiene la última UF de la sesión (marcada como no actualizada) si existe.
+        if uf_cached:
+            uf_api, fuente = uf_cached[1], f"{uf_cached[2]} · sin actualizar (API no disponible)"
+        else:
+            uf_api, fuente = UF_RESPALDO, "UF manual (API no disponible)"
+
+uf_valor_txt = st.text_input(
+    "Valor de 1 UF en CLP (editable)",
+    value=f"{int(round(uf_api)):n}".replace(",", "."),
+    help=f"Fuente sugerida: {fuente}. Puedes modificarla libremente."
+)
 
 uf_valor = parse_num(uf_valor_txt, uf_api)
 st.info(f"Valor UF usado: **{formato_clp(uf_valor)}** · Fuente: {fuente}")
@@ -232,18 +174,21 @@ st.info(f"Valor UF usado: **{formato_clp(uf_valor)}** · Fuente: {fuente}")
 # ------------------------------
 # Entradas principales (abiertas)
 # ------------------------------
-col1, col2 = st.columns(2)
-
-with col1:
-    precio_uf_txt = st.text_input("Valor cuota / Precio unitario (UF)", value="1,40")
-with col2:
-    monto_descuento_txt = st.text_input(
-        "Monto de descuento solicitado (CLP)",
-        value="8000",
-        help=f"Tope por nivel: {int(max_desc*100)}% del subtotal (incl. IVA)"
-    )
+# En un formulario: escribir no provoca reruns, solo "Calcular" (o Enter)
+with st.form("calc"):
+    col1, col2 = st.columns(2)
+
+    with col1:
+        precio_uf_txt = st.text_input("Valor cuota / Precio unitario (UF)", value="1,40")
+    with col2:
+        monto_descuento_txt = st.text_input(
+            "Monto de descuento solicitado (CLP)",
+            value="8000",
+            help=f"Tope por nivel: {max_desc_pct}% del subtotal (incl. IVA)"
+        )
 
-cant_txt = st.text_input("Cantidad", value="1")
+    cant_txt = st.text_input("Cantidad", value="1")
+    st.form_submit_button("Calcular")
 
 # Parseo seguro
 precio_uf = parse_num(precio_uf_txt, 0.0)
@@ -270,13 +215,6 @@ excede_tope = monto_descuento_ing > monto_tope
 monto_aplicado = min(monto_descuento_ing, monto_tope)
 porcentaje_aplicado = (monto_aplicado / subtotal * 100) if subtotal > 0 else 0.0
 
-if excede_tope:
-    st.error(
-        f"El monto solicitado {formato_clp(monto_descuento_ing)} excede el tope permitido para {nivel} "
-        f"(máx {int(max_desc*100)}% = {formato_clp(monto_tope)} del subtotal con IVA). Se aplicará el tope.",
-        icon="⛔",
-    )
-
 # Totales (Total con IVA porque el subtotal ya lo incluye)
 DescuentoCLP = monto_aplicado                      # descuento sin IVA
 TotalCLP = max(subtotal - DescuentoCLP, 0)
@@ -284,25 +222,36 @@ TotalCLP = max(subtotal - DescuentoCLP, 0)
 # ------------------------------
 # Resultados
 # ------------------------------
-fila1_c1, fila1_c2 = st.columns(2)
-with fila1_c1:
-    st.metric("Subtotal (incl. IVA 19%)", formato_clp(subtotal))
-with fila1_c2:
-    st.metric(
-        "Descuento solicitado",
-        formato_clp(monto_descuento_ing),
-        delta=f"{porcentaje_solicitado:.1f}% del subtotal"
-    )
+# Todo en un contenedor, con un espacio fijo para el aviso de tope: que el aviso
+# aparezca o no, no desplaza ni vuelve a montar los elementos que vienen después.
+with st.container():
+    aviso_tope = st.empty()
+    if excede_tope:
+        aviso_tope.error(
+            f"El monto solicitado {formato_clp(monto_descuento_ing)} excede el tope permitido para {nivel} "
+            f"(máx {max_desc_pct}% = {formato_clp(monto_tope)} del subtotal con IVA). Se aplicará el tope.",
+            icon="⛔",
+        )
 
-fila2_c1, fila2_c2 = st.columns(2)
-with fila2_c1:
-    st.metric(
-        "Descuento aplicado",
-        formato_clp(DescuentoCLP),
-        delta=f"{porcentaje_aplicado:.1f}% del subtotal"
-    )
-with fila2_c2:
-    st.metric("Total a pagar (incl. IVA)", formato_clp(TotalCLP))
+    fila1_c1, fila1_c2 = st.columns(2)
+    with fila1_c1:
+        st.metric("Subtotal (incl. IVA 19%)", formato_clp(subtotal))
+    with fila1_c2:
+        st.metric(
+            "Descuento solicitado",
+            formato_clp(monto_descuento_ing),
+            delta=f"{porcentaje_solicitado:.1f}% del subtotal"
+        )
+
+    fila2_c1, fila2_c2 = st.columns(2)
+    with fila2_c1:
+        st.metric(
+            "Descuento aplicado",
+            formato_clp(DescuentoCLP),
+            delta=f"{porcentaje_aplicado:.1f}% del subtotal"
+        )
+    with fila2_c2:
+        st.metric("Total a pagar (incl. IVA)", formato_clp(TotalCLP))
 
 
 # ------------------------------
@@ -314,23 +263,31 @@ with st.expander("Opciones avanzadas"):
         TotalCLP = round(TotalCLP / 1000) * 1000
         st.write(f"Total redondeado: **{formato_clp(TotalCLP)}**")
 
-    st.text_area(
-        "Resumen",
-        value=(
-            f"UF usada (editable): {uf_valor:.2f} CLP\n"
-            f"Precio unitario: {precio_uf:.2f} UF ({formato_clp(precio_unitario_clp_neto)} neto)\n"
-            f"Cantidad: {int(cantidad)}\n"
-            f"IVA incluido (19%): {formato_clp(iva_incluido)}\n"
-            f"Subtotal (incl. IVA): {formato_clp(subtotal)}\n"
-            f"Descuento solicitado: {formato_clp(monto_descuento_ing)} ({porcentaje_solicitado:.1f}% del subtotal)\n"
-            f"Descuento aplicado: {formato_clp(DescuentoCLP)} ({porcentaje_aplicado:.1f}% del subtotal)\n"
-            f"Total a pagar (incl. IVA): {formato_clp(TotalCLP)}\n"
-        ),
-        height=200,
-    )
+    # El resumen solo se arma si se pide (el expander no evita ejecutar su contenido)
+    if st.toggle("Mostrar resumen", key="adv_open"):
+        st.text_area(
+            "Resumen",
+            value=(
+                f"UF usada (editable): {uf_valor:.2f} CLP\n"
+                f"Precio unitario: {precio_uf:.2f} UF ({formato_clp(precio_unitario_clp_neto)} neto)\n"
+                f"Cantidad: {int(cantidad)}\n"
+                f"IVA incluido (19%): {formato_clp(iva_incluido)}\n"
+                f"Subtotal (incl. IVA): {formato_clp(subtotal)}\n"
+                f"Descuento solicitado: {formato_clp(monto_descuento_ing)} ({porcentaje_solicitado:.1f}% del subtotal)\n"
+                f"Descuento aplicado: {formato_clp(DescuentoCLP)} ({porcentaje_aplicado:.1f}% del subtotal)\n"
+                f"Total a pagar (incl. IVA): {formato_clp(TotalCLP)}\n"
+            ),
+            height=200,
+        )
 
 st.caption(
     "Los topes de descuento se calculan sobre el **subtotal con IVA**. "
     "Las entradas son abiertas: puedes escribir con coma/punto y miles. "
     "La UF se precarga desde la API pero puedes modificarla."
 )
+
+# Si la UF aún no llega, espera un momento y vuelve a pintar. La espera es corta para
+# no dejar bloqueadas las interacciones del usuario mientras la consulta sigue en curso.
+if uf_pendiente:
+    wait([uf_future(hoy)], timeout=0.5)
+    st.rerun()
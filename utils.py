@@ -0,0 +1,279 @@
+# utils.py — Helpers compartidos de la Calculadora de Retención
+# Se importa una sola vez por proceso: Streamlit re-ejecuta app_rete.py en cada
+# interacción, pero los módulos importados quedan en sys.modules.
+
+import requests
+import streamlit as st
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime
+from functools import lru_cache
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from zoneinfo import ZoneInfo
+import os, time, hmac, hashlib, base64, binascii, json, struct, tempfile
+
+# ==============================
+# Config de niveles y topes
+# ==============================
+# Constantes de módulo: se construyen una vez por proceso, no en cada rerun
+IVA_RATE = 0.19  # 19% Chile
+NIVELES = ("Nivel 1", "Telecierre")
+NIVEL_IDX = {nivel: i for i, nivel in enumerate(NIVELES)}
+TOPES_BASE = (0.25, 0.40)  # mismo orden que NIVELES
+
+# ==============================
+# Formato / parseo
+# ==============================
+# Tablas precompiladas: una sola pasada en C en vez de encadenar str.replace
+_FMT_TRANS = str.maketrans(",", ".")
+_PARSE_TRANS = str.maketrans({".": None, ",": "."})
+
+@lru_cache(maxsize=256)
+def formato_clp(valor: float) -> str:
+    """Formatea CLP con miles con punto y sin decimales."""
+    v = valor or 0.0
+    entero = int(v + 0.5) if v >= 0 else -int(-v + 0.5)  # redondeo al peso, mitades hacia afuera
+    return "$ " + format(entero, ",").translate(_FMT_TRANS)
+
+def parse_num(s, default=0.0) -> float:
+    """
+    Convierte strings con ',' o '.' a float.
+    Acepta miles con punto (p.ej. '1.234,56').
+    """
+    try:
+        if isinstance(s, (int, float)):
+            return float(s)
+        # elimina separador de miles '.' y usa '.' como decimal
+        return float(str(s).strip().translate(_PARSE_TRANS))
+    except Exception:
+        return float(default)
+
+# ==============================
+# UF
+# ==============================
+@st.cache_resource
+def _http() -> requests.Session:
+    """Sesión HTTP compartida (keep-alive): evita un handshake TCP+TLS por consulta."""
+    s = requests.Session()
+    s.headers.update({"User-Agent": "ret-calc/1.0", "Accept": "application/json"})
+    # Reintenta solo respuestas 5xx transitorias; timeouts de conexión/lectura no se
+    # reintentan, así un servidor colgado cuesta como máximo un intento (3 s + 5 s).
+    retry = Retry(
+        total=2, connect=0, read=0, status=2,
+        backoff_factor=0.2, status_forcelist=[502, 503, 504],
+    )
+    s.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry))
+    return s
+
+_TZ_CHILE = ZoneInfo("America/Santiago")
+
+def dia_uf() -> str:
+    """Fecha de hoy en Chile (ISO): la UF cambia a medianoche de Santiago, no del servidor."""
+    return datetime.now(_TZ_CHILE).date().isoformat()
+
+# La UF es un valor diario: el último valor obtenido se guarda en disco con la fecha
+# que informa la API, así un worker nuevo o un reinicio del mismo día no vuelve a consultarla.
+UF_CACHE_PATH = Path.home() / ".streamlit" / "uf_cache.json"
+
+def _leer_uf_disco(dia: str):
+    try:
+        d = json.loads(UF_CACHE_PATH.read_text())
+        if d["fecha"] != dia:
+            return None
+        return float(d["valor"]), d["fuente"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def _guardar_uf_disco(fecha: str, valor: float, fuente: str) -> None:
+    """Escritura atómica: archivo temporal propio de cada escritor + os.replace."""
+    tmp = None
+    try:
+        UF_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=UF_CACHE_PATH.parent, prefix="uf_cache.", suffix=".tmp", delete=False
+        ) as f:
+            tmp = f.name
+            json.dump({"valor": valor, "fuente": fuente, "fecha": fecha}, f)
+        os.replace(tmp, UF_CACHE_PATH)
+    except OSError:
+        if tmp is not None:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+def _consultar_uf() -> tuple[float, str, str]:
+    """Consulta mindicador.cl; retorna (valor, fuente, fecha ISO de la UF) o lanza excepción."""
+    url = "https://mindicador.cl/api/uf"
+    r = _http().get(url, timeout=(3, 5))  # (conexión, lectura)
+    r.raise_for_status()
+    data = r.json()
+    serie = data.get("serie", [])
+    if not serie:
+        raise RuntimeError("Respuesta sin datos de UF")
+    valor = float(serie[0]["valor"])  # CLP por 1 UF
+    fecha_iso = serie[0]["fecha"]
+    d = date.fromisoformat(fecha_iso[:10])  # "2024-05-12T00:00:00.000Z" → 2024-05-12
+    fecha = f"{d.day:02d}-{d.month:02d}-{d.year}"
+    return valor, f"mindicador.cl (UF del {fecha})", d.isoformat()
+
+@st.cache_data(ttl=24 * 60 * 60, show_spinner=False)
+def obtener_uf_hoy(dia: str) -> tuple[float, str]:
+    """
+    Intenta obtener la UF del día `dia` (ISO en hora de Chile, ver dia_uf()).
+    `dia` es la clave de la caché: al cambiar el día se consulta de nuevo.
+    Retorna (valor_uf_en_clp, fuente_texto) o lanza excepción si falla, incluso si
+    la API responde con la UF de otro día (no se cachea ni se guarda en disco).
+    """
+    cache = _leer_uf_disco(dia)
+    if cache is not None:
+        return cache
+    valor, fuente, fecha = _consultar_uf()
+    if fecha != dia:
+        raise RuntimeError(f"mindicador.cl entregó la UF del {fecha}, no la del {dia}")
+    _guardar_uf_disco(fecha, valor, fuente)
+    return valor, fuente
+
+@st.cache_resource
+def _uf_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="uf")
+
+# Una caída de la API se recuerda este tiempo antes de volver a consultar
+UF_ERROR_TTL = 5 * 60
+
+def _obtener_uf_seguro(dia: str) -> tuple:
+    """No lanza: ("ok", valor, fuente) o ("err", momento_del_fallo, mensaje)."""
+    try:
+        valor, fuente = obtener_uf_hoy(dia)
+        return "ok", valor, fuente
+    except Exception as e:
+        return "err", time.time(), str(e)
+
+@st.cache_resource(max_entries=2)
+def uf_future(dia: str) -> Future:
+    """
+    Lanza la consulta de la UF del día en segundo plano (una vez por día y proceso),
+    para pintar la UI sin esperar la red. `dia` es la clave de caché y el día consultado.
+    """
+    return _uf_executor().submit(_obtener_uf_seguro, dia)
+
+# Último resultado terminado por día: se sigue entregando mientras corre un reintento
+_UF_ULTIMO: dict[str, tuple] = {}
+
+def uf_estado(dia: str):
+    """
+    Resultado de uf_future(dia), o None si aún no hay ningún resultado para ese día.
+    Un fallo se sigue devolviendo durante UF_ERROR_TTL; luego se relanza la consulta
+    en segundo plano y, hasta que termine, se sigue devolviendo el fallo anterior.
+    """
+    fut = uf_future(dia)
+    if not fut.done():
+        return _UF_ULTIMO.get(dia)
+    res = fut.result()
+    if _UF_ULTIMO.get(dia) is not res:
+        _UF_ULTIMO.clear()  # descarta días anteriores
+        _UF_ULTIMO[dia] = res
+    if res[0] == "err" and time.time() - res[1] > UF_ERROR_TTL:
+        uf_future.clear()
+        uf_future(dia)
+    return res
+
+# ==============================
+# Roles / Autorización
+# ==============================
+@st.cache_resource
+def _load_auth_config() -> tuple[frozenset, str | None, str]:
+    """Lee la sección [auth] de secrets.toml una sola vez, compartida entre sesiones."""
+    auth = st.secrets.get("auth", {})
+    return (
+        frozenset(auth.get("admins", ())),
+        auth.get("admin_passcode", None),
+        auth.get("token_key", "dev-secret-change-me"),
+    )
+
+ADMINS, ADMIN_PASSCODE, TOKEN_KEY = _load_auth_config()
+
+@lru_cache(maxsize=32)
+def is_admin(email: str) -> bool:
+    return email in ADMINS
+
+# ==============================
+# Sesión / parámetros
+# ==============================
+# Compatibilidad entre versiones de Streamlit: se detecta una sola vez al importar
+_HAS_ST_USER = hasattr(st, "user")
+_HAS_ST_QP = hasattr(st, "query_params")
+
+def get_user_email():
+    """Compatibilidad st.user (nuevo) y experimental_user (viejo)."""
+    if _HAS_ST_USER:
+        email = getattr(st.user, "email", None)
+        if email:
+            return email
+    u_old = getattr(st, "experimental_user", None)
+    return getattr(u_old, "email", None) if u_old is not None else None
+
+def get_query_param(name: str):
+    if _HAS_ST_QP:
+        return st.query_params.get(name, None)
+    q = st.experimental_get_query_params()
+    if name in q:
+        v = q[name]
+        return v[0] if isinstance(v, list) else v
+    return None
+
+# ==============================
+# Tokens temporales para agentes (?flash=TOKEN)
+# ==============================
+# HMAC ya inicializado con la clave; se copia en cada firma/verificación
+_HMAC_TEMPLATE = hmac.new(TOKEN_KEY.encode(), None, hashlib.sha256)
+
+def _firmar(msg: bytes) -> bytes:
+    h = _HMAC_TEMPLATE.copy()
+    h.update(msg)
+    return h.digest()
+
+_SIG_LEN = hashlib.sha256().digest_size  # 32 bytes
+
+# Payload de largo fijo: exp (u64), n1 % (f64), tel % (f64), versión (u8) = 25 bytes
+_TOK = struct.Struct("<QddB")
+_TOK_VERSION = 2  # v1 era JSON
+
+# Un token válido mide 78 caracteres; se rechaza basura larga antes de decodificar
+MAX_TOKEN_LEN = 512
+
+def make_flash_token(hours: int, n1_pct: float, tel_pct: float) -> str:
+    """Crea un token firmado con expiración y topes flash."""
+    msg = _TOK.pack(
+        int(time.time()) + hours * 3600,
+        float(n1_pct),   # % Nivel 1
+        float(tel_pct),  # % Telecierre
+        _TOK_VERSION,
+    )
+    sig = _firmar(msg)
+    # Sin relleno "=" (como itsdangerous): enlaces más cortos y sin escapar en la URL
+    return base64.urlsafe_b64encode(msg + b"." + sig).rstrip(b"=").decode()
+
+def verify_flash_token(token: str):
+    if not token or len(token) > MAX_TOKEN_LEN:
+        return False, "Largo de token inválido"
+    try:
+        data = base64.urlsafe_b64decode(token.encode() + b"=" * (-len(token) % 4))
+    except (binascii.Error, ValueError):
+        return False, "Token mal formado"
+    # La firma SHA-256 mide siempre 32 bytes (dato público): se corta por posición,
+    # ya que la firma puede contener b".", y se descarta sin calcular el HMAC.
+    msg, sep, sig = data[:-_SIG_LEN - 1], data[-_SIG_LEN - 1:-_SIG_LEN], data[-_SIG_LEN:]
+    if sep != b"." or len(sig) != _SIG_LEN:
+        return False, "Firma inválida"
+    if len(msg) != _TOK.size:
+        return False, "Token mal formado"
+    if not hmac.compare_digest(sig, _firmar(msg)):
+        return False, "Firma inválida"
+    exp, n1_pct, tel_pct, v = _TOK.unpack(msg)
+    if v != _TOK_VERSION:
+        return False, "Token mal formado"
+    if exp < time.time():
+        return False, "Token vencido"
+    return True, {"exp": exp, "n1": n1_pct, "tel": tel_pct, "v": v}